@@ -1,15 +1,23 @@
 import streamlit as st
+import numpy as np
 import pandas as pd
-from fpdf import FPDF
-from fpdf.enums import XPos, YPos
 import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+from itertools import zip_longest
 from datetime import datetime
 import io
 
 # --- 0. 版本号 ---
 VERSION = "v1.3.2"
 
+# 字体路径与存在性在导入时解析一次，导出热路径上不再做文件系统调用
+_FONT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "font.ttf")
+_FONT_OK = os.path.exists(_FONT_PATH)
+
 # --- 1. 基础工具函数 ---
+@st.cache_data(max_entries=64)
 def get_densities(temp):
     """根据温度输出纯水和生理盐水(0.9% NaCl)的密度 (g/cm3)"""
     rho_water = 1000 * (1 - (temp + 288.9414) / (508929.2 * (temp + 68.12963)) * (temp - 3.9863)**2)
@@ -29,6 +37,20 @@ def calc_theoretical_masses(tc, tm, c_h, rho_h, c_l, rho_l):
     m_h = max(0.0, min(float(m_h), float(tm)))
     return m_h, tm - m_h
 
+def calc_theoretical_masses_vec(tc_arr, tm, c_h, rho_h, c_l, rho_l):
+    """calc_theoretical_masses 的向量化版本，对整个目标浓度数组一次性求解"""
+    tc_arr = np.asarray(tc_arr, dtype=float)
+    # 先取密度倒数：标量密度时整列除法退化为一次标量除法 + 向量乘法
+    inv_rho_h = 1.0 / np.asarray(rho_h, dtype=float)
+    inv_rho_l = 1.0 / np.asarray(rho_l, dtype=float)
+    k1 = (c_h - tc_arr) * inv_rho_h
+    k2 = (tc_arr - c_l) * inv_rho_l
+    denom = k1 + k2
+    ratio = np.divide(tm * k2, denom, out=np.zeros_like(tc_arr), where=denom != 0)
+    m_h = np.where(tc_arr >= c_h, tm, np.where(tc_arr <= c_l, 0.0, ratio))
+    m_h = np.clip(m_h, 0.0, tm)
+    return m_h, tm - m_h
+
 def calc_actual_volume_conc(m_h, m_l, c_h, rho_h, c_l, rho_l):
     """回算实际体积浓度"""
     v_h = m_h / rho_h
@@ -36,40 +58,138 @@ def calc_actual_volume_conc(m_h, m_l, c_h, rho_h, c_l, rho_l):
     if (v_h + v_l) == 0: return 0.0
     return (v_h * c_h + v_l * c_l) / (v_h + v_l)
 
+def calc_actual_volume_conc_vec(m_h_arr, m_l_arr, c_h_arr, rho_h_arr, c_l_arr, rho_l_arr):
+    """calc_actual_volume_conc 的向量化版本，对整批梯度行一次性回算"""
+    v_h = np.asarray(m_h_arr, dtype=float) * (1.0 / np.asarray(rho_h_arr, dtype=float))
+    v_l = np.asarray(m_l_arr, dtype=float) * (1.0 / np.asarray(rho_l_arr, dtype=float))
+    denom = v_h + v_l
+    num = v_h * np.asarray(c_h_arr, dtype=float) + v_l * np.asarray(c_l_arr, dtype=float)
+    return np.divide(num, denom, out=np.zeros_like(denom), where=denom != 0)
+
+@st.cache_data(max_entries=64)
+def make_grid(c_low, c_mid, c_high, n):
+    """生成低/高两段拼接的目标浓度网格；标量参数不变时直接命中缓存"""
+    lo = np.linspace(c_low, c_mid, n // 2, endpoint=False)
+    hi = np.linspace(c_mid, c_high, n - n // 2)
+    return np.concatenate([lo, hi])
+
+@st.cache_data(max_entries=64)
+def compute_suggested_prep(num_points, c_h_orig, c_l_orig, rho_h_orig, rho_l_orig, target_tm_each):
+    """预估中间浓度猜测值与理论总用量；参数不变时直接命中缓存，跳过整个预计算"""
+    target_c_mid_guess = round((c_h_orig + c_l_orig)/2, 2)
+    all_targets_temp = make_grid(c_l_orig, target_c_mid_guess, c_h_orig, num_points)
+    # 两个分段各做一次向量化求解，再按掩码取中间浓度用量，替代逐点 Python 循环
+    is_high_temp = all_targets_temp > target_c_mid_guess + 0.0001
+    _, m_mid_high = calc_theoretical_masses_vec(all_targets_temp, target_tm_each, c_h_orig, rho_h_orig, target_c_mid_guess, 1.0)
+    m_mid_low, _ = calc_theoretical_masses_vec(all_targets_temp, target_tm_each, target_c_mid_guess, 1.0, c_l_orig, rho_l_orig)
+    total_mid_usage = float(m_mid_high[is_high_temp].sum() + m_mid_low[~is_high_temp].sum())
+    return target_c_mid_guess, total_mid_usage
+
+@st.cache_data(max_entries=64)
+def compute_actual_mid(m_h_act, m_l_act, c_h, rho_h, c_l, rho_l):
+    """由实测加入质量反推中间实际浓度/密度。
+    结果量化到固定小数位，浮点抖动不会改变下游以其为 key 的控件身份。"""
+    actual_c_mid = calc_actual_volume_conc(m_h_act, m_l_act, c_h, rho_h, c_l, rho_l)
+    denom = (m_h_act / rho_h) + (m_l_act / rho_l)
+    actual_rho_mid = (m_h_act + m_l_act) / denom if denom > 0 else 1.0
+    return round(actual_c_mid, 4), round(actual_rho_mid, 6)
+
+@st.cache_data(max_entries=64)
+def plan_gradient(num_points, c_h, rho_h, c_l, rho_l, actual_c_mid, actual_rho_mid):
+    """梯度规划的纯计算部分：目标网格、分段掩码与每行混合参数。
+    只依赖标量输入，与表格无关的控件改动在 rerun 时直接命中缓存。"""
+    all_targets = make_grid(c_l, actual_c_mid, c_h, num_points)
+    # 分段掩码一次算好，材料名称与 (浓度, 密度) 参数全部按掩码整列取值，行内不再分支
+    is_high_seg = all_targets > actual_c_mid + 0.0001
+    ca_arr = np.where(is_high_seg, c_h, actual_c_mid)
+    ra_arr = np.where(is_high_seg, rho_h, actual_rho_mid)
+    cb_arr = np.where(is_high_seg, actual_c_mid, c_l)
+    rb_arr = np.where(is_high_seg, actual_rho_mid, rho_l)
+    mat_a = np.where(is_high_seg, "高浓度", "中间浓度")
+    mat_b = np.where(is_high_seg, "中间浓度", "低浓度")
+    return all_targets, is_high_seg, ca_arr, ra_arr, cb_arr, rb_arr, mat_a, mat_b
+
 # --- 2. PDF 生成类 ---
-class PDFWithFooter(FPDF):
-    def __init__(self, version, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.version = version
-
-    def footer(self):
-        self.set_y(-15)
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        font_path = os.path.join(current_dir, "font.ttf")
-        if os.path.exists(font_path):
-            self.set_font('Font', '', 8)
-            version_text = f"版本: {self.version} | 程序创建者：Rong | 第 {self.page_no()} 页"
+@st.cache_resource(show_spinner=False)
+def _get_pdf_class():
+    """首次导出时才导入 fpdf 并定义 PDF 类，交互路径不再承担库的冷启动开销"""
+    from fpdf import FPDF
+
+    class PDFWithFooter(FPDF):
+        def __init__(self, version, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.version = version
+            # 存在性复用模块级常量，构造实例不再做路径解析和 stat()，
+            # 也保证页脚与正文对字体可用性的判断一致
+            self._font_ok = _FONT_OK
+            # 字体选择与文案前后缀在此定型，footer() 每页只剩格式化页码和一次 cell
+            if self._font_ok:
+                self._footer_font = ('Font', '', 8)
+                self._footer_prefix = f"版本: {self.version} | 程序创建者：Rong | 第 "
+                self._footer_suffix = " 页"
+            else:
+                self._footer_font = ('Arial', 'I', 8)
+                self._footer_prefix = f"Version: {self.version} | Creator: Rong | Page "
+                self._footer_suffix = ""
+
+        def footer(self):
+            self.set_y(-15)
+            self.set_font(*self._footer_font)
+            self.set_text_color(150, 150, 150)
+            self.cell(0, 10, text=f"{self._footer_prefix}{self.page_no()}{self._footer_suffix}", align='R')
+
+    return PDFWithFooter
+
+# Arial 等核心字体只支持 Latin-1；缺字体时用单次 C 层 translate 剔除非 ASCII 字符，
+# 而不是逐单元格 encode('ascii','ignore').decode() 做两趟全量转码
+_ASCII_STRIP = defaultdict(lambda: None, {i: i for i in range(128)})
+
+def _ascii_safe(s):
+    return str(s).translate(_ASCII_STRIP)
+
+def _format_pdf_df(df, int_first_col=False, ascii_only=False):
+    """按列一次性把表格数据格式化为字符串，行循环里不再做列名扫描和 isinstance 判断"""
+    # 修复点：先检查是否为数字，再根据列名判断保留位数
+    fmts = ["{:.2f}" if "浓度" in str(c) else "{:.1f}" for c in df.columns]
+    out = df.copy()
+    for i, c in enumerate(df.columns):
+        if int_first_col and i == 0:
+            out[c] = df[c].map(lambda x: str(int(x)))
         else:
-            self.set_font('Arial', 'I', 8)
-            version_text = f"Version: {self.version} | Creator: Rong | Page {self.page_no()}"
-        self.set_text_color(150, 150, 150)
-        self.cell(0, 10, text=version_text, align='R')
+            out[c] = df[c].map(lambda x, f=fmts[i]: f.format(x) if isinstance(x, (int, float)) else str(x))
+        if ascii_only:
+            out[c] = out[c].map(_ascii_safe)
+    return out
+
+def _pdf_cache_key(df_main, df_mid, meta_info):
+    """对报告内容做 blake2b 指纹，作为会话级 PDF 字节缓存的键"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(pd.util.hash_pandas_object(df_main, index=False).values.tobytes())
+    h.update(pd.util.hash_pandas_object(df_mid, index=False).values.tobytes())
+    h.update(repr(sorted(meta_info.items())).encode())
+    return h.digest()
 
 def create_pdf(df_main, df_mid, title, meta_info):
+    from fpdf.enums import XPos, YPos
+    from fpdf.fonts import FontFace
+
     version = meta_info.get("程序版本", "N/A")
-    pdf = PDFWithFooter(version=version)
+    pdf = _get_pdf_class()(version=version)
 
     # 设置页边距：左25mm, 上20mm, 右20mm
     pdf.set_margins(left=25, top=20, right=20)
     pdf.add_page()
-    
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    font_path = os.path.join(current_dir, "font.ttf")
-    font_ok = False
-    if os.path.exists(font_path):
-        pdf.add_font('Font', '', font_path)
+
+    # 页面度量只取一次，后续排版全部引用局部变量
+    eff_w = pdf.w - pdf.l_margin - pdf.r_margin
+    half_w = eff_w / 2
+
+    font_ok = _FONT_OK
+    if font_ok:
+        # fpdf2 的字体子集状态绑定在单个文档实例上，TTF 解析无法跨文档复用，
+        # 只能保证每份报告注册一次；重复导出由会话级内容指纹缓存兜底
+        pdf.add_font('Font', '', _FONT_PATH)
         pdf.set_font('Font', size=16)
-        font_ok = True
     else:
         pdf.set_font('Arial', size=16)
 
@@ -79,18 +199,20 @@ def create_pdf(df_main, df_mid, title, meta_info):
     
     # 2. 元数据
     pdf.set_font('Font' if font_ok else 'Arial', size=10)
-    effective_width = pdf.w - pdf.l_margin - pdf.r_margin
     items = list(meta_info.items())
-    for i in range(0, len(items), 2):
-        k1, v1 = items[i]
-        pdf.cell(effective_width/2, 8, text=f"{k1}: {v1}", new_x=XPos.RIGHT, new_y=YPos.TOP)
-        if i + 1 < len(items):
-            k2, v2 = items[i+1]
-            pdf.cell(effective_width/2, 8, text=f"{k2}: {v2}", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
-        else: pdf.ln(8)
-            
+    if not font_ok:
+        items = [(_ascii_safe(k), _ascii_safe(v)) for k, v in items]
+    meta_texts = [f"{k}: {v}" for k, v in items]
+    # 两列栅格交给一次 table() 调用排版，省去逐项 cell 的布局开销
+    with pdf.table(col_widths=(half_w, half_w), borders_layout="NONE", line_height=8,
+                   text_align="LEFT", first_row_as_headings=False) as table:
+        for left, right in zip_longest(meta_texts[0::2], meta_texts[1::2], fillvalue=""):
+            row = table.row()
+            row.cell(left)
+            row.cell(right)
+
     pdf.ln(4)
-    pdf.line(pdf.l_margin, pdf.get_y(), pdf.w - pdf.r_margin, pdf.get_y())
+    pdf.line(pdf.l_margin, pdf.get_y(), pdf.l_margin + eff_w, pdf.get_y())
     pdf.ln(5)
 
     # 3. 中间浓度配置详情
@@ -98,20 +220,16 @@ def create_pdf(df_main, df_mid, title, meta_info):
     pdf.cell(0, 10, text="一、中间浓度配置详情" if font_ok else "1. Intermediate Prep", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
     
     pdf.set_font('Font' if font_ok else 'Arial', size=9)
-    col_width_mid = effective_width / len(df_mid.columns)
-    pdf.set_fill_color(245, 245, 245)
-    for col in df_mid.columns:
-        pdf.cell(col_width_mid, 8, text=str(col), border=1, align='C', fill=True)
-    pdf.ln()
-    for _, row in df_mid.iterrows():
-        for i, item in enumerate(row):
-            # 修复点：先检查是否为数字，再根据列名判断保留位数
-            if isinstance(item, (int, float)):
-                val = f"{item:.2f}" if "浓度" in df_mid.columns[i] else f"{item:.1f}"
-            else:
-                val = str(item)
-            pdf.cell(col_width_mid, 8, text=val, border=1, align='C')
-        pdf.ln()
+    # 单次 table() 调用批量排版，避免逐单元格 cell() 的重复度量开销
+    with pdf.table(text_align="CENTER", line_height=8,
+                   headings_style=FontFace(fill_color=(245, 245, 245))) as table:
+        header = table.row()
+        for col in df_mid.columns:
+            header.cell(str(col) if font_ok else _ascii_safe(col))
+        for rec in _format_pdf_df(df_mid, ascii_only=not font_ok).itertuples(index=False, name=None):
+            r = table.row()
+            for val in rec:
+                r.cell(val)
     pdf.ln(10)
 
     # 4. 分段梯度稀释方案
@@ -120,20 +238,18 @@ def create_pdf(df_main, df_mid, title, meta_info):
 
     pdf.set_font('Font' if font_ok else 'Arial', size=9)
     cols = df_main.columns.tolist()
-    col_width = effective_width / len(cols)
-    pdf.set_fill_color(235, 235, 235)
-    for col in cols:
-        pdf.cell(col_width, 10, text=str(col), border=1, align='C', fill=True)
-    pdf.ln()
-    for _, row in df_main.iterrows():
-        for i, item in enumerate(row):
-            if i == 0: val = str(int(item))
-            elif isinstance(item, (int, float)):
-                val = f"{item:.2f}" if "浓度" in cols[i] else f"{item:.1f}"
-            else: val = str(item)
-            pdf.cell(col_width, 10, text=val, border=1, align='C')
-        pdf.ln()
-    return pdf.output()
+    with pdf.table(text_align="CENTER", line_height=10,
+                   headings_style=FontFace(fill_color=(235, 235, 235))) as table:
+        header = table.row()
+        for col in cols:
+            header.cell(str(col) if font_ok else _ascii_safe(col))
+        for rec in _format_pdf_df(df_main, int_first_col=True, ascii_only=not font_ok).itertuples(index=False, name=None):
+            r = table.row()
+            for val in rec:
+                r.cell(val)
+    # fpdf 返回 bytearray，而 download_button 的封送只接受 str/bytes/IO，
+    # 在出口处一次性转成不可变 bytes，调用方可直接透传
+    return bytes(pdf.output())
 
 # --- 3. 界面初始化 ---
 st.set_page_config(page_title="线性评价样本制备程序", layout="wide")
@@ -153,14 +269,19 @@ st.markdown("""
 st.caption(f"版本: {VERSION}")
 
 # XLSX 导入
+@st.cache_data(show_spinner=False)
+def _load_archive(raw):
+    """按文件内容缓存存档解析；上传控件持有文件期间的后续 rerun 不再重复解压解析"""
+    xls = pd.ExcelFile(io.BytesIO(raw))
+    return xls.parse("配置参数"), xls.parse("梯度方案")
+
 import_data = {}
 with st.sidebar.expander("📂 导入 XLSX 存档", expanded=False):
     uploaded_file = st.file_uploader("选择存档文件", type="xlsx", label_visibility="collapsed")
     if uploaded_file:
         try:
-            df_settings = pd.read_excel(uploaded_file, sheet_name="配置参数")
+            df_settings, df_grad_import = _load_archive(uploaded_file.getvalue())
             import_data = dict(zip(df_settings["参数"], df_settings["数值"]))
-            df_grad_import = pd.read_excel(uploaded_file, sheet_name="梯度方案")
             st.success("导入成功")
         except: st.error("导入失败")
 
@@ -175,7 +296,8 @@ with st.sidebar:
     unit_mass = c_u2.text_input("质量单位", value=import_data.get("质量单位", "mg"))
     
     input_temp = st.number_input("环境温度 (°C)", value=float(import_data.get("环境温度", 22.0)), step=0.5)
-    rho_w, rho_s = get_densities(input_temp)
+    # 量化到 0.01°C 再查缓存，近似相同的温度共用同一槽位（密度本身只保留 5 位小数）
+    rho_w, rho_s = get_densities(round(input_temp, 2))
     st.write(f"💧 **纯水密度**: `{rho_w}` g/cm3  |  🏥 **生理盐水**: `{rho_s}` g/cm3")
     
     st.markdown("---")
@@ -192,16 +314,7 @@ with st.sidebar:
     target_tm_each = c_p6.number_input(f"单点配置量 ({unit_mass})", value=float(import_data.get("单点计划总量", 350.0)), step=10.0)
 
 # --- 4. 预计算与中间配置 ---
-target_c_mid_guess = round((c_h_orig + c_l_orig)/2, 2)
-mid_idx_guess = num_points // 2
-pts_low_temp = [c_l_orig + i * ((target_c_mid_guess - c_l_orig) / mid_idx_guess) for i in range(mid_idx_guess)]
-pts_high_temp = [target_c_mid_guess + i * ((c_h_orig - target_c_mid_guess) / (num_points - mid_idx_guess - 1)) for i in range(num_points - mid_idx_guess)]
-all_targets_temp = pts_low_temp + pts_high_temp
-total_mid_usage = 0.0
-for t_c in all_targets_temp:
-    if t_c > target_c_mid_guess + 0.0001: _, m_mid = calc_theoretical_masses(t_c, target_tm_each, c_h_orig, rho_h_orig, target_c_mid_guess, 1.0)
-    else: m_mid, _ = calc_theoretical_masses(t_c, target_tm_each, target_c_mid_guess, 1.0, c_l_orig, rho_l_orig)
-    total_mid_usage += m_mid
+target_c_mid_guess, total_mid_usage = compute_suggested_prep(num_points, c_h_orig, c_l_orig, rho_h_orig, rho_l_orig, target_tm_each)
 suggested_m = round(total_mid_usage * 1.1, 1)
 
 st.markdown("#### 1️⃣ 中间浓度配置")
@@ -217,83 +330,143 @@ with st.container(border=True):
         # 实际加入质量使用动态 Key，随理论建议值变化自动同步
         m_h_mid_act = st.number_input("加入高浓度实测", value=float(import_data.get("中间实测A", round(m_h_theo, 1))), min_value=0.0, step=0.1, format="%.1f", key=f"mha_{m_h_theo}")
         m_l_mid_act = st.number_input("加入低浓度实测", value=float(import_data.get("中间实测B", round(m_l_theo, 1))), min_value=0.0, step=0.1, format="%.1f", key=f"mla_{m_l_theo}")
-        actual_c_mid = calc_actual_volume_conc(m_h_mid_act, m_l_mid_act, c_h_orig, rho_h_orig, c_l_orig, rho_l_orig)
-        denom = (m_h_mid_act/rho_h_orig) + (m_l_mid_act/rho_l_orig)
-        actual_rho_mid = (m_h_mid_act + m_l_mid_act) / denom if denom > 0 else 1.0
+        actual_c_mid, actual_rho_mid = compute_actual_mid(
+            m_h_mid_act, m_l_mid_act, c_h_orig, rho_h_orig, c_l_orig, rho_l_orig)
         st.warning(f"🧪 **中间实际参数**：浓度 **{actual_c_mid:.2f}** | 密度 **{actual_rho_mid:.4f}**")
 
 # --- 5. 梯度方案 ---
 st.markdown("#### 2️⃣ 分段梯度稀释方案")
-mid_idx = num_points // 2
-pts_low = [c_l_orig + i * ((actual_c_mid - c_l_orig) / mid_idx) for i in range(mid_idx)]
-pts_high = [actual_c_mid + i * ((c_h_orig - actual_c_mid) / (num_points - mid_idx - 1)) for i in range(num_points - mid_idx)]
-all_targets = pts_low + pts_high
-
-h_cols = st.columns([0.5, 1.2, 1.2, 1.2, 1.2, 1.2, 1.2])
-headers = ["序号", "目标浓度", "材料A", "材料B", "加入A质量", "加入B质量", "实际浓度"]
-for col, lab in zip(h_cols, headers): col.write(f"**{lab}**")
-
-results_data = []
-total_h = m_h_mid_act
-total_l = m_l_mid_act
-
-for i, t_c in enumerate(all_targets):
-    idx = i + 1
-    if t_c > actual_c_mid + 0.0001: m_a, m_b, ca, ra, cb, rb = "高浓度", "中间浓度", c_h_orig, rho_h_orig, actual_c_mid, actual_rho_mid
-    else: m_a, m_b, ca, ra, cb, rb = "中间浓度", "低浓度", actual_c_mid, actual_rho_mid, c_l_orig, rho_l_orig
-    
-    imp_tc, imp_ma, imp_mb = t_c, None, None
-    if 'df_grad_import' in locals() and i < len(df_grad_import):
-        imp_tc, imp_ma, imp_mb = df_grad_import.iloc[i]["目标浓度"], df_grad_import.iloc[i]["加入A质量"], df_grad_import.iloc[i]["加入B质量"]
-    
-    r_cols = st.columns([0.5, 1.2, 1.2, 1.2, 1.2, 1.2, 1.2])
-    r_cols[0].write(f"{idx}")
-    # 动态 Key 确保梯度目标随中间浓度变化刷新
-    row_tc = r_cols[1].number_input(f"tc_{i}", value=float(imp_tc), format="%.2f", step=0.1, key=f"rtc_{i}_{actual_c_mid}", label_visibility="collapsed")
-    r_cols[2].write(m_a); r_cols[3].write(m_b)
-    
-    m_a_t, m_b_t = calc_theoretical_masses(row_tc, target_tm_each, ca, ra, cb, rb)
-    # 梯度实测框使用动态 Key，确保理论配比变化时强制更新输入框
-    row_ma = r_cols[4].number_input(f"ma_{i}", value=float(imp_ma if imp_ma is not None else round(m_a_t, 1)), min_value=0.0, step=0.1, format="%.1f", key=f"rma_{i}_{actual_c_mid}_{row_tc}", label_visibility="collapsed")
-    row_mb = r_cols[5].number_input(f"mb_{i}", value=float(imp_mb if imp_mb is not None else round(m_b_t, 1)), min_value=0.0, step=0.1, format="%.1f", key=f"rmb_{i}_{actual_c_mid}_{row_tc}", label_visibility="collapsed")
-    
-    act_c = calc_actual_volume_conc(row_ma, row_mb, ca, ra, cb, rb)
-    r_cols[6].write(f"**{act_c:.2f}**")
-    results_data.append({"序号": idx, "目标浓度": row_tc, "材料A": m_a, "材料B": m_b, "加入A质量": row_ma, "加入B质量": row_mb, "最终实际浓度": act_c})
-    if m_a == "高浓度": total_h += row_ma
-    if m_b == "低浓度": total_l += row_mb
+all_targets, is_high_seg, ca_arr, ra_arr, cb_arr, rb_arr, mat_a, mat_b = plan_gradient(
+    num_points, c_h_orig, rho_h_orig, c_l_orig, rho_l_orig, actual_c_mid, actual_rho_mid)
+
+df_edit = pd.DataFrame({
+    "序号": np.arange(1, num_points + 1),
+    "目标浓度": np.round(all_targets, 2),
+    "材料A": mat_a,
+    "材料B": mat_b,
+    "加入A质量": 0.0,
+    "加入B质量": 0.0,
+})
+# XLSX 导入值优先作为默认
+if 'df_grad_import' in locals():
+    n_imp = min(len(df_grad_import), num_points)
+    for col in ("目标浓度", "加入A质量", "加入B质量"):
+        df_edit.loc[:n_imp - 1, col] = df_grad_import[col].iloc[:n_imp].astype(float).values
+
+# 动态 Key：中间浓度或点数变化时重置表格；单一 data_editor 取代 N×7 个独立控件
+editor_key = f"grad_editor_{num_points}_{actual_c_mid}"
+# 先套用用户未提交进 DataFrame 的编辑，保证理论默认值与实际浓度列在本次 rerun 就是最新的
+pending = st.session_state.get(editor_key, {}).get("edited_rows", {})
+for ridx, changes in pending.items():
+    for col, val in changes.items():
+        if col in df_edit.columns and val is not None:
+            df_edit.loc[int(ridx), col] = val
+# 未被用户手动改过的质量列，默认值跟随（可能已被编辑的）目标浓度的理论配比；
+# 理论配比对整列一次向量化求解，循环里只剩掩码式回填
+m_a_t_arr, m_b_t_arr = calc_theoretical_masses_vec(
+    df_edit["目标浓度"].to_numpy(dtype=float), target_tm_each, ca_arr, ra_arr, cb_arr, rb_arr)
+for i in range(num_points):
+    edited_cols = pending.get(i, {})
+    if "加入A质量" not in edited_cols and not df_edit.loc[i, "加入A质量"] > 0:
+        df_edit.loc[i, "加入A质量"] = round(float(m_a_t_arr[i]), 1)
+    if "加入B质量" not in edited_cols and not df_edit.loc[i, "加入B质量"] > 0:
+        df_edit.loc[i, "加入B质量"] = round(float(m_b_t_arr[i]), 1)
+df_edit["实际浓度"] = np.round(calc_actual_volume_conc_vec(
+    df_edit["加入A质量"], df_edit["加入B质量"], ca_arr, ra_arr, cb_arr, rb_arr), 2)
+
+edited = st.data_editor(
+    df_edit, hide_index=True, use_container_width=True, num_rows="fixed", key=editor_key,
+    disabled=["序号", "材料A", "材料B", "实际浓度"],
+    column_config={
+        "序号": st.column_config.NumberColumn(width="small"),
+        "目标浓度": st.column_config.NumberColumn(format="%.2f", step=0.1),
+        "加入A质量": st.column_config.NumberColumn(format="%.1f", min_value=0.0, step=0.1),
+        "加入B质量": st.column_config.NumberColumn(format="%.1f", min_value=0.0, step=0.1),
+        "实际浓度": st.column_config.NumberColumn(format="%.2f"),
+    })
+
+act_c_arr = calc_actual_volume_conc_vec(edited["加入A质量"], edited["加入B质量"], ca_arr, ra_arr, cb_arr, rb_arr)
+results_df = edited.drop(columns=["实际浓度"]).assign(最终实际浓度=np.round(act_c_arr, 2))
+total_h = m_h_mid_act + edited.loc[edited["材料A"] == "高浓度", "加入A质量"].sum()
+total_l = m_l_mid_act + edited.loc[edited["材料B"] == "低浓度", "加入B质量"].sum()
 
 # --- 6. 导出 ---
 st.divider()
-ex_l, ex_r = st.columns(2)
+
+def build_xlsx_bytes():
+    s_dict = {
+        "实验内容": exp_name, "浓度单位": unit_conc, "质量单位": unit_mass, "环境温度": input_temp,
+        "原液浓度A": c_h_orig, "原液密度A": rho_h_orig, "原液浓度B": c_l_orig, "原液密度B": rho_l_orig,
+        "样本点数": num_points, "单点计划总量": target_tm_each, "中间目标浓度": target_c_mid, "中间计划总量": prep_m_mid,
+        "中间实测A": m_h_mid_act, "中间实测B": m_l_mid_act
+    }
+    import xlsxwriter  # 延迟导入：只有导出时才需要
+
+    output = io.BytesIO()
+    # constant_memory：按行流式写入 zip；两张小表直接 write_row 写出，
+    # 不再为序列化专门构造 DataFrame 走 to_excel
+    with xlsxwriter.Workbook(output, {'constant_memory': True, 'in_memory': True}) as workbook:
+        ws_s = workbook.add_worksheet("配置参数")
+        ws_s.write_row(0, 0, ("参数", "数值"))
+        for r, item in enumerate(s_dict.items(), start=1):
+            ws_s.write_row(r, 0, item)
+        ws_g = workbook.add_worksheet("梯度方案")
+        ws_g.write_row(0, 0, results_df.columns.tolist())
+        for r, rec in enumerate(results_df.itertuples(index=False, name=None), start=1):
+            ws_g.write_row(r, 0, rec)
+    # 直接交出 BytesIO：download_button 内部取字节，省去 getvalue() 的整缓冲区拷贝
+    return output
+
+def build_pdf_inputs():
+    df_mid_pdf = pd.DataFrame([
+        {"组分": "高浓度材料", "理论质量": m_h_theo, "加入质量": m_h_mid_act, "目标浓度": "-", "实际配置浓度": "-"},
+        {"组分": "低浓度材料", "理论质量": m_l_theo, "加入质量": m_l_mid_act, "目标浓度": "-", "实际配置浓度": "-"},
+        {"组分": "合计(中间浓度)", "理论质量": m_h_theo+m_l_theo, "加入质量": m_h_mid_act+m_l_mid_act, "目标浓度": target_c_mid, "实际配置浓度": actual_c_mid}
+    ])
+    df_mid_pdf.columns = ["组分", f"理论质量({unit_mass})", f"加入质量({unit_mass})", f"目标浓度({unit_conc})", f"实际配置浓度({unit_conc})"]
+    meta = {
+        "实验内容": exp_name, "环境温度": f"{input_temp} degC", "水密度": f"{rho_w} g/cm3", "生理盐水密度": f"{rho_s} g/cm3",
+        "高浓度材料": f"{c_h_orig} {unit_conc} (密度:{rho_h_orig:.4f})",
+        "低浓度材料": f"{c_l_orig} {unit_conc} (密度:{rho_l_orig:.4f})", "中间浓度材料": f"{actual_c_mid:.2f} {unit_conc} (密度:{actual_rho_mid:.4f})",
+        "高浓度材料合计量": f"{total_h:.1f} {unit_mass}", "低浓度材料合计量": f"{total_l:.1f} {unit_mass}","生成时间": datetime.now().strftime("%Y-%m-%d %H:%M"), "程序版本": VERSION
+    }
+    return df_mid_pdf, meta
+
+def build_pdf_bytes():
+    df_mid_pdf, meta = build_pdf_inputs()
+    key = _pdf_cache_key(results_df, df_mid_pdf, meta)
+    # 内容指纹未变时复用上次的字节，重复点击导出不再重新排版整份报告
+    if st.session_state.get("_pdf_cache_key") == key:
+        return st.session_state["_pdf_cache_bytes"]
+    # create_pdf 已输出不可变 bytes，进缓存后重复点击零拷贝复用
+    pdf_bytes = create_pdf(results_df, df_mid_pdf, "线性评价样本制备记录", meta)
+    st.session_state["_pdf_cache_key"] = key
+    st.session_state["_pdf_cache_bytes"] = pdf_bytes
+    return pdf_bytes
+
+ex_l, ex_m, ex_r = st.columns(3)
 with ex_l:
     if st.button("💾 导出 XLSX 存档", use_container_width=True):
-        s_dict = {
-            "实验内容": exp_name, "浓度单位": unit_conc, "质量单位": unit_mass, "环境温度": input_temp,
-            "原液浓度A": c_h_orig, "原液密度A": rho_h_orig, "原液浓度B": c_l_orig, "原液密度B": rho_l_orig,
-            "样本点数": num_points, "单点计划总量": target_tm_each, "中间目标浓度": target_c_mid, "中间计划总量": prep_m_mid,
-            "中间实测A": m_h_mid_act, "中间实测B": m_l_mid_act
-        }
-        df_s = pd.DataFrame(list(s_dict.items()), columns=["参数", "数值"])
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df_s.to_excel(writer, sheet_name="配置参数", index=False)
-            pd.DataFrame(results_data).to_excel(writer, sheet_name="梯度方案", index=False)
-        st.download_button("📥 下载 XLSX", data=output.getvalue(), file_name=f"{exp_name}.xlsx", use_container_width=True)
+        st.download_button("📥 下载 XLSX", data=build_xlsx_bytes(), file_name=f"{exp_name}.xlsx", use_container_width=True)
 
-with ex_r:
+with ex_m:
     if st.button("📑 生成 PDF 报告", use_container_width=True):
-        df_mid_pdf = pd.DataFrame([
-            {"组分": "高浓度材料", "理论质量": m_h_theo, "加入质量": m_h_mid_act, "目标浓度": "-", "实际配置浓度": "-"},
-            {"组分": "低浓度材料", "理论质量": m_l_theo, "加入质量": m_l_mid_act, "目标浓度": "-", "实际配置浓度": "-"},
-            {"组分": "合计(中间浓度)", "理论质量": m_h_theo+m_l_theo, "加入质量": m_h_mid_act+m_l_mid_act, "目标浓度": target_c_mid, "实际配置浓度": actual_c_mid}
-        ])
-        df_mid_pdf.columns = ["组分", f"理论质量({unit_mass})", f"加入质量({unit_mass})", f"目标浓度({unit_conc})", f"实际配置浓度({unit_conc})"]
-        meta = {
-            "实验内容": exp_name, "环境温度": f"{input_temp} degC", "水密度": f"{rho_w} g/cm3", "生理盐水密度": f"{rho_s} g/cm3",
-            "高浓度材料": f"{c_h_orig} {unit_conc} (密度:{rho_h_orig:.4f})",
-            "低浓度材料": f"{c_l_orig} {unit_conc} (密度:{rho_l_orig:.4f})", "中间浓度材料": f"{actual_c_mid:.2f} {unit_conc} (密度:{actual_rho_mid:.4f})",
-            "高浓度材料合计量": f"{total_h:.1f} {unit_mass}", "低浓度材料合计量": f"{total_l:.1f} {unit_mass}","生成时间": datetime.now().strftime("%Y-%m-%d %H:%M"), "程序版本": VERSION
-        }
-        pdf_out = create_pdf(pd.DataFrame(results_data), df_mid_pdf, "线性评价样本制备记录", meta)
-        st.download_button("📥 下载 PDF", data=bytes(pdf_out), file_name=f"Report_{exp_name}.pdf", use_container_width=True)
\ No newline at end of file
+        st.download_button("📥 下载 PDF", data=build_pdf_bytes(), file_name=f"Report_{exp_name}.pdf", use_container_width=True)
+
+with ex_r:
+    if st.button("📦 一键导出 PDF + XLSX", use_container_width=True):
+        # 两种序列化互相独立且大量时间花在 zip/deflate（释放 GIL），并行生成约快一倍
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            future_xlsx = pool.submit(build_xlsx_bytes)
+            # 会话缓存只能在主线程访问，工作线程里只跑纯函数 create_pdf
+            df_mid_pdf, meta = build_pdf_inputs()
+            key = _pdf_cache_key(results_df, df_mid_pdf, meta)
+            if st.session_state.get("_pdf_cache_key") == key:
+                pdf_bytes = st.session_state["_pdf_cache_bytes"]
+            else:
+                pdf_bytes = pool.submit(create_pdf, results_df, df_mid_pdf, "线性评价样本制备记录", meta).result()
+                st.session_state["_pdf_cache_key"] = key
+                st.session_state["_pdf_cache_bytes"] = pdf_bytes
+            xlsx_bytes = future_xlsx.result()
+        st.download_button("📥 下载 XLSX", data=xlsx_bytes, file_name=f"{exp_name}.xlsx", use_container_width=True, key="dl_both_xlsx")
+        st.download_button("📥 下载 PDF", data=pdf_bytes, file_name=f"Report_{exp_name}.pdf", use_container_width=True, key="dl_both_pdf")
\ No newline at end of file